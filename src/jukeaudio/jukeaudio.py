@@ -1,20 +1,52 @@
 """Module for working with Juke Audio device"""
 
 import aiohttp
+import asyncio
 import base64
 import json
+import time
+import weakref
 
+from functools import lru_cache
 from .exceptions import AuthenticationException, UnexpectedException
-from typing import List
+from typing import Any, Dict, List, Optional, Set, Tuple
+from yarl import URL
+
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+except ImportError:
+    from json import dumps as _json_dumps, loads as _json_loads
+
+try:
+    from msgspec.json import decode as _json_loads
+except ImportError:
+    pass
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 api_version = "v2"
 
 import logging
 logger = logging.getLogger(__name__)
 
+@lru_cache(maxsize=32)
 def create_auth_header(user_name: str, password: str):
     """Return auth header value"""
-    return base64.b64encode(bytes(f"{user_name}:{password}", "utf-8")).decode("utf-8")
+    return base64.b64encode(f"{user_name}:{password}".encode()).decode("ascii")
+
+
+@lru_cache(maxsize=32)
+def _auth_headers(user_name: str, password: str) -> Dict[str, str]:
+    """Return request headers for the credentials, shared between requests (do not modify)"""
+    return {"Authorization": f"Bearer {create_auth_header(user_name, password)}"}
 
 
 def is_juke_compatible(ver: str):
@@ -22,25 +54,203 @@ def is_juke_compatible(ver: str):
     return ver.startswith(f"{api_version}.")
 
 
+def _decode_json(raw: bytes):
+    """Decode a JSON response body, returning None for an empty body"""
+    return _json_loads(raw) if raw.strip() else None
+
+
+def _as_ids(contents, key: str) -> List[str]:
+    """Return the id list from a collection response"""
+    return contents[key] if isinstance(contents, dict) else contents
+
+
+async def _gather_by_id(ids: List[str], fetch, concurrency: int) -> Dict[str, Any]:
+    """Fetch each id concurrently, keeping at most concurrency requests in flight"""
+    if concurrency < 1:
+        raise ValueError(f"concurrency must be at least 1, got {concurrency}")
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch_one(item_id: str):
+        async with semaphore:
+            return await fetch(item_id)
+
+    results = await asyncio.gather(*(fetch_one(item_id) for item_id in ids))
+    return dict(zip(ids, results))
+
+
+@lru_cache(maxsize=32)
+def _root_url(ip_address: str) -> URL:
+    """Return the parsed URL of the API root on a device"""
+    return URL(f"http://{ip_address}/api/")
+
+
+@lru_cache(maxsize=256)
+def _api_url(ip_address: str, path: str) -> URL:
+    """Return the parsed URL of an API path on a device"""
+    return URL(f"http://{ip_address}/api/{api_version}/{path}")
+
+
+def _status_error(exc: aiohttp.ClientResponseError, action: str) -> Exception:
+    """Map an HTTP error response to the matching client exception"""
+    if exc.status == 401 or exc.status == 403:
+        logger.error(f"Authentication error: {exc.status}")
+        return AuthenticationException()
+    logger.error(f"Error {action}: {exc.status}")
+    return UnexpectedException(exc.status)
+
+
 class JukeAudioClient:
     """Class for working with Juke Audio device"""
+
+    # Seconds to wait before writing a zone volume, so that rapid successive
+    # changes (e.g. dragging a slider) are sent as a single request
+    volume_delay = 0.05
+
+    # Responses up to this many bytes are decoded whole rather than streamed
+    # by get_device_metrics_fields
+    stream_threshold = 64 * 1024
+
+    def __init__(self):
+        self._session = None
+        self._loop = None
+        self._cache: Dict[tuple, Tuple[float, bytes]] = {}
+        self._etags: Dict[tuple, Optional[Tuple[str, bytes]]] = {}
+        self._pending_volume: Dict[Tuple[str, str, str], Tuple[str, str, int]] = {}
+        self._volume_tasks: Dict[Tuple[str, str, str], asyncio.Future] = {}
+        self._volume_locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+        self._volume_writes: Set[asyncio.Future] = set()
+
+    def _check_loop(self):
+        """Drop the session and volume state if they belong to another event loop
+
+        A session left on an earlier loop cannot be closed from this one, so
+        callers should close the client before that loop shuts down.
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is None or self._loop() is not loop:
+            # Held weakly so get_client() can drop a closed client with its loop
+            self._loop = weakref.ref(loop)
+            self._session = None
+            self._pending_volume.clear()
+            self._volume_tasks.clear()
+            self._volume_locks.clear()
+            self._volume_writes.clear()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Return the shared session, creating it on first use"""
+        self._check_loop()
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=16,
+                limit_per_host=8,
+                keepalive_timeout=120,
+                ttl_dns_cache=300,
+                enable_cleanup_closed=True,
+                force_close=False,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers={"Connection": "keep-alive"},
+                json_serialize=_json_dumps,
+                timeout=aiohttp.ClientTimeout(total=5, connect=1),
+            )
+        return self._session
+
+    async def flush(self):
+        """Wait for pending and in-flight volume writes to finish"""
+        self._check_loop()
+        while self._volume_writes:
+            await asyncio.gather(*self._volume_writes, return_exceptions=True)
+
+    async def close(self):
+        """Send pending writes and close the shared session"""
+        await self.flush()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _invalidate(self, ip_address: str, prefix: str):
+        """Drop cached responses for paths starting with prefix"""
+        for cache_key in [k for k in self._cache if k[0] == ip_address and k[2].startswith(prefix)]:
+            del self._cache[cache_key]
+
+    async def _get_json(self, ip_address: str, username: str, password: str, path: str, key: str = None, params: dict = None, ttl: float = 0, conditional: bool = False):
+        """Get a JSON resource from the device API
+
+        Responses are cached for ttl seconds. With conditional, the last ETag
+        is sent as If-None-Match and a 304 reply reuses the previous body.
+        Cached bodies are kept as bytes and decoded on every call, so callers
+        never share result objects.
+        """
+        auth = create_auth_header(username, password)
+        cache_key = (ip_address, auth, path, frozenset(params.items()) if params else None)
+        if ttl > 0:
+            cached = self._cache.get(cache_key)
+            if cached is not None and time.monotonic() - cached[0] < ttl:
+                contents = _decode_json(cached[1])
+                return contents if key is None else contents[key]
+        if conditional and cache_key in self._etags and self._etags[cache_key] is None:
+            # The device did not send an ETag for this resource
+            conditional = False
+        try:
+            hdr = _auth_headers(username, password)
+            etag = self._etags.get(cache_key) if conditional else None
+            if etag is not None:
+                hdr = {**hdr, "If-None-Match": etag[0]}
+            session = self._get_session()
+            response = await session.get(_api_url(ip_address, path), headers=hdr, params=params)
+            try:
+                response.raise_for_status()
+                if response.status == 304 and etag is not None:
+                    raw = etag[1]
+                    contents = _decode_json(raw)
+                else:
+                    raw = await response.read()
+                    contents = _decode_json(raw)
+                    if conditional:
+                        tag = response.headers.get("ETag")
+                        self._etags[cache_key] = None if tag is None else (tag, raw)
+            finally:
+                response.release()
+            if ttl > 0:
+                self._cache[cache_key] = (time.monotonic(), raw)
+            return contents if key is None else contents[key]
+        except aiohttp.ClientResponseError as exc:
+            raise _status_error(exc, f"getting {path}") from exc
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            raise UnexpectedException from exc
+        except ValueError as exc:
+            # The body was not valid JSON (e.g. an HTML error page)
+            logger.error(f"Error decoding {path}: {exc}")
+            raise UnexpectedException from exc
+
     async def can_connect_to_juke(self, ip_address: str):
-        """Verify connectivity to a compatible Juke device"""
+        """Verify connectivity to a compatible Juke device
+
+        The probe goes through the shared session, so the connection it opens
+        stays in the pool and is reused by the first API call that follows.
+        """
         logger.debug(f"Verifying connectivity to Juke with ip_address={ip_address}")
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f"http://{ip_address}/api/") as response:
-                    try:
-                        contents = await response.json(content_type=None)
-                        return is_juke_compatible(contents["versions"][0])
-                    except:
-                        ### Juke currently is not returning JSON from the current API so we need to parse it manually
-                        contents = await response.text()
-                        contents = contents.replace("'", "\"")
-                        versions = json.loads(contents)
-                        for ver in versions:
-                            if is_juke_compatible(ver):
-                                return True
+            session = self._get_session()
+            async with session.get(_root_url(ip_address)) as response:
+                try:
+                    contents = await response.json(content_type=None)
+                    return is_juke_compatible(contents["versions"][0])
+                except:
+                    ### Juke currently is not returning JSON from the current API so we need to parse it manually
+                    contents = await response.text()
+                    contents = contents.replace("'", "\"")
+                    versions = json.loads(contents)
+                    for ver in versions:
+                        if is_juke_compatible(ver):
+                            return True
 
         except Exception as exc:
             logger.error(f"Error connecting to Juke device: {exc}")
@@ -50,305 +260,240 @@ class JukeAudioClient:
     async def get_devices(self, ip_address: str, username: str, password: str) -> List[str]:
         """Get device list"""
         logger.debug(f"Invoking get_devices with ip_address={ip_address}")
-        try:
-            hdr = {"Authorization": f"Bearer {create_auth_header(username, password)}"}
-            async with aiohttp.ClientSession(headers=hdr) as session:
-                async with session.get(f"http://{ip_address}/api/{api_version}/devices/") as response:
-                    if response.status != 200:
-                        if response.status == 401 or response.status == 403:
-                            logger.error(f"Authentication error: {response.status}")
-                            raise AuthenticationException
-                        else:
-                            logger.error(f"Error getting devices: {response.status}")
-                            raise UnexpectedException(response.status)
-                    else:
-                        contents = await response.json()
-                        return contents
-        except aiohttp.ClientError as exc:
-            raise UnexpectedException from exc
-        
+        return await self._get_json(ip_address, username, password, "devices/", ttl=30)
+
     async def get_device_connection_info(self, ip_address: str, username: str, password: str, device_id: str):
         """Get connection information"""
         logger.debug(f"Invoking get_device_connection_info with ip_address={ip_address}, device_id={device_id}")
-        try:
-            hdr = {"Authorization": f"Bearer {create_auth_header(username, password)}"}
-            async with aiohttp.ClientSession(headers=hdr) as session:
-                async with session.get(f"http://{ip_address}/api/{api_version}/devices/{device_id}/connection") as response:
-                    if response.status != 200:
-                        if response.status == 401 or response.status == 403:
-                            logger.error(f"Authentication error: {response.status}")
-                            raise AuthenticationException
-                        else:
-                            logger.error(f"Error getting device connection info: {response.status}")
-                            raise UnexpectedException(response.status)
-                    else:
-                        contents = await response.json()
-                        return contents
-        except aiohttp.ClientError as exc:
-            raise UnexpectedException from exc
+        return await self._get_json(ip_address, username, password, f"devices/{device_id}/connection")
 
     async def get_device_attributes(self, ip_address: str, username: str, password: str, device_id: str):
         """Get device attributes"""
         logger.debug(f"Invoking get_device_attributes with ip_address={ip_address}, device_id={device_id}")
-        try:
-            hdr = {"Authorization": f"Bearer {create_auth_header(username, password)}"}
-            async with aiohttp.ClientSession(headers=hdr) as session:
-                async with session.get(f"http://{ip_address}/api/{api_version}/devices/{device_id}/attributes") as response:
-                    if response.status != 200:
-                        if response.status == 401 or response.status == 403:
-                            logger.error(f"Authentication error: {response.status}")
-                            raise AuthenticationException
-                        else:
-                            logger.error(f"Error getting device attributes: {response.status}")
-                            raise UnexpectedException(response.status)
-                    else:
-                        contents = await response.json()
-                        return contents
-        except aiohttp.ClientError as exc:
-            raise UnexpectedException from exc
+        return await self._get_json(ip_address, username, password, f"devices/{device_id}/attributes", ttl=10, conditional=True)
 
     async def get_device_config(self, ip_address: str, username: str, password: str, device_id: str):
         """Get device config"""
         logger.debug(f"Invoking get_device_config with ip_address={ip_address}, device_id={device_id}")
-        try:
-            hdr = {"Authorization": f"Bearer {create_auth_header(username, password)}"}
-            async with aiohttp.ClientSession(headers=hdr) as session:
-                async with session.get(f"http://{ip_address}/api/{api_version}/devices/{device_id}/config") as response:
-                    if response.status != 200:
-                        if response.status == 401 or response.status == 403:
-                            logger.error(f"Authentication error: {response.status}")
-                            raise AuthenticationException
-                        else:
-                            logger.error(f"Error getting device config: {response.status}")
-                            raise UnexpectedException(response.status)
-                    else:
-                        contents = await response.json()
-                        return contents
-        except aiohttp.ClientError as exc:
-            raise UnexpectedException from exc
+        return await self._get_json(ip_address, username, password, f"devices/{device_id}/config", conditional=True)
 
     async def get_device_metrics(self, ip_address: str, username: str, password: str, device_id: str):
         """Get device metrics"""
         logger.debug(f"Invoking get_device_metrics with ip_address={ip_address}, device_id={device_id}")
+        return await self._get_json(ip_address, username, password, f"devices/{device_id}/metrics")
+
+    async def get_device_metrics_fields(self, ip_address: str, username: str, password: str, device_id: str, fields: Set[str]) -> Dict[str, Any]:
+        """Get selected top-level device metrics
+
+        With ijson installed, responses without a Content-Length or larger
+        than stream_threshold bytes are parsed as they stream in, and reading
+        stops once all requested fields have been seen. Stopping early closes
+        the connection instead of returning it to the pool, so smaller
+        responses are read whole and decoded normally.
+        """
+        logger.debug(f"Invoking get_device_metrics_fields with ip_address={ip_address}, device_id={device_id}, fields={fields}")
+        if ijson is None:
+            metrics = await self.get_device_metrics(ip_address, username, password, device_id)
+            return {name: metrics[name] for name in fields if name in metrics}
+        path = f"devices/{device_id}/metrics"
         try:
-            hdr = {"Authorization": f"Bearer {create_auth_header(username, password)}"}
-            async with aiohttp.ClientSession(headers=hdr) as session:
-                async with session.get(f"http://{ip_address}/api/{api_version}/devices/{device_id}/metrics") as response:
-                    if response.status != 200:
-                        if response.status == 401 or response.status == 403:
-                            logger.error(f"Authentication error: {response.status}")
-                            raise AuthenticationException
-                        else:
-                            logger.error(f"Error getting device metrics: {response.status}")
-                            raise UnexpectedException(response.status)
-                    else:
-                        contents = await response.json()
-                        return contents
-        except aiohttp.ClientError as exc:
+            hdr = _auth_headers(username, password)
+            session = self._get_session()
+            async with session.get(_api_url(ip_address, path), headers=hdr) as response:
+                response.raise_for_status()
+                if response.content_length is not None and response.content_length <= self.stream_threshold:
+                    metrics = _decode_json(await response.read())
+                    return {name: metrics[name] for name in fields if name in metrics}
+                found = {}
+                async for name, value in ijson.kvitems(response.content, "", use_float=True):
+                    if name in fields:
+                        found[name] = value
+                        if len(found) == len(fields):
+                            break
+                return found
+        except aiohttp.ClientResponseError as exc:
+            raise _status_error(exc, f"getting {path}") from exc
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            raise UnexpectedException from exc
+        except (ValueError, ijson.JSONError) as exc:
+            logger.error(f"Error decoding {path}: {exc}")
             raise UnexpectedException from exc
 
     async def get_zones(self, ip_address: str, username: str, password: str):
         """Get zone ids"""
         logger.debug(f"Invoking get_zones with ip_address={ip_address}")
-        try:
-            hdr = {"Authorization": f"Bearer {create_auth_header(username, password)}"}
-            async with aiohttp.ClientSession(headers=hdr) as session:
-                async with session.get(f"http://{ip_address}/api/{api_version}/zones") as response:
-                    if response.status != 200:
-                        if response.status == 401 or response.status == 403:
-                            logger.error(f"Authentication error: {response.status}")
-                            raise AuthenticationException
-                        else:
-                            logger.error(f"Error getting zones: {response.status}")
-                            raise UnexpectedException(response.status)
-                    else:
-                        contents = await response.json()
-                        return contents
-        except aiohttp.ClientError as exc:
-            raise UnexpectedException from exc
+        return await self._get_json(ip_address, username, password, "zones", ttl=30)
 
     async def get_zone_config(self, ip_address: str, username: str, password: str, zone_id: str):
         """Get zone config"""
         logger.debug(f"Invoking get_zone_config with ip_address={ip_address}, zone_id={zone_id}")
-        try:
-            hdr = {"Authorization": f"Bearer {create_auth_header(username, password)}"}
-            async with aiohttp.ClientSession(headers=hdr) as session:
-                async with session.get(f"http://{ip_address}/api/{api_version}/zones/{zone_id}") as response:
-                    if response.status != 200:
-                        if response.status == 401 or response.status == 403:
-                            logger.error(f"Authentication error: {response.status}")
-                            raise AuthenticationException
-                        else:
-                            logger.error(f"Error getting zone config: {response.status}")
-                            raise UnexpectedException(response.status)
-                    else:
-                        contents = await response.json()
-                        return contents
-        except aiohttp.ClientError as exc:
-            raise UnexpectedException from exc
-        
+        return await self._get_json(ip_address, username, password, f"zones/{zone_id}", conditional=True)
+
     async def set_zone_volume(self, ip_address: str, username: str, password: str, zone_id: str, volume: int):
         """Set zone volume"""
         logger.debug(f"Invoking set_zone_volume with ip_address={ip_address}, zone_id={zone_id}, volume={volume}")
+        self._check_loop()
+        # Only callers with the same credentials share a write, so one
+        # caller's bad password cannot fail another's request
+        key = (ip_address, zone_id, create_auth_header(username, password))
+        self._pending_volume[key] = (username, password, volume)
+        task = self._volume_tasks.get(key)
+        if task is None:
+            task = self._volume_tasks[key] = asyncio.ensure_future(self._flush_volume(key))
+            self._volume_writes.add(task)
+            task.add_done_callback(self._volume_written)
+        return await asyncio.shield(task)
+
+    def _volume_written(self, task: asyncio.Future):
+        """Forget a finished volume write
+
+        Its error is marked as retrieved, since every caller awaiting the
+        write may have been cancelled; asyncio would otherwise log it.
+        """
+        self._volume_writes.discard(task)
+        if not task.cancelled():
+            task.exception()
+
+    async def _flush_volume(self, key: Tuple[str, str, str]):
+        """Write the latest volume requested for a zone
+
+        Writes to the same zone are serialized; values requested while an
+        earlier write is in flight are merged and sent once it completes.
+        """
+        lock = self._volume_locks.get(key[:2])
+        if lock is None:
+            lock = self._volume_locks[key[:2]] = asyncio.Lock()
+        try:
+            await asyncio.sleep(self.volume_delay)
+            await lock.acquire()
+        finally:
+            del self._volume_tasks[key]
+            username, password, volume = self._pending_volume.pop(key)
+        try:
+            return await self._put_zone_volume(key[0], username, password, key[1], volume)
+        finally:
+            lock.release()
+
+    async def _put_zone_volume(self, ip_address: str, username: str, password: str, zone_id: str, volume: int):
+        """Send zone volume to the device"""
         try:
-            hdr = {"Authorization": f"Bearer {create_auth_header(username, password)}"}
-            async with aiohttp.ClientSession(headers=hdr) as session:
-                async with session.put(f"http://{ip_address}/api/{api_version}/zones/{zone_id}/volume", data = { "volume": volume}) as response:
-                    if response.status != 200:
-                        if response.status == 401 or response.status == 403:
-                            logger.error(f"Authentication error: {response.status}")
-                            raise AuthenticationException
-                        else:
-                            logger.error(f"Error setting zone volume: {response.status}")
-                            raise UnexpectedException(response.status)
-                    else:
-                        contents = await response.text()
-                        return contents
-        except aiohttp.ClientError as exc:
+            hdr = _auth_headers(username, password)
+            session = self._get_session()
+            async with session.put(_api_url(ip_address, f"zones/{zone_id}/volume"), json = { "volume": volume}, headers=hdr) as response:
+                response.raise_for_status()
+                self._invalidate(ip_address, "zones")
+                contents = await response.text()
+                return contents
+        except aiohttp.ClientResponseError as exc:
+            raise _status_error(exc, "setting zone volume") from exc
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
             raise UnexpectedException from exc
 
     async def set_zone_input(self, ip_address: str, username: str, password: str, zone_id: str, input: str):
         """Set zone input"""
         logger.debug(f"Invoking set_zone_input with ip_address={ip_address}, zone_id={zone_id}, input={input}")
         try:
-            hdr = {"Authorization": f"Bearer {create_auth_header(username, password)}"}
-            data = "[]"
+            hdr = _auth_headers(username, password)
+            data = []
             if input is not None and len(input)>0:
-                data = f"[\"{input}\"]"
-
-            async with aiohttp.ClientSession(headers=hdr) as session:
-                async with session.put(f"http://{ip_address}/api/{api_version}/zones/{zone_id}/input", data = data) as response:
-                    if response.status != 200:
-                        if response.status == 401 or response.status == 403:
-                            logger.error(f"Authentication error: {response.status}")
-                            raise AuthenticationException
-                        else:
-                            logger.error(f"Error setting zone input: {response.status}")
-                            raise UnexpectedException(response.status)
-                    else:
-                        contents = await response.text()
-                        return contents
-        except aiohttp.ClientError as exc:
+                data = [input]
+
+            session = self._get_session()
+            async with session.put(_api_url(ip_address, f"zones/{zone_id}/input"), json = data, headers=hdr) as response:
+                response.raise_for_status()
+                self._invalidate(ip_address, "zones")
+                contents = await response.text()
+                return contents
+        except aiohttp.ClientResponseError as exc:
+            raise _status_error(exc, "setting zone input") from exc
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
             raise UnexpectedException from exc
 
     async def get_inputs(self, ip_address: str, username: str, password: str):
         """Get input ids"""
         logger.debug(f"Invoking get_inputs with ip_address={ip_address}")
-        try:
-            hdr = {"Authorization": f"Bearer {create_auth_header(username, password)}"}
-            async with aiohttp.ClientSession(headers=hdr) as session:
-                async with session.get(f"http://{ip_address}/api/{api_version}/inputs") as response:
-                    if response.status != 200:
-                        if response.status == 401 or response.status == 403:
-                            logger.error(f"Authentication error: {response.status}")
-                            raise AuthenticationException
-                        else:
-                            logger.error(f"Error getting inputs: {response.status}")
-                            raise UnexpectedException(response.status)
-                    else:
-                        contents = await response.json()
-                        return contents
-        except aiohttp.ClientError as exc:
-            raise UnexpectedException from exc
+        return await self._get_json(ip_address, username, password, "inputs", ttl=30)
 
     async def get_input_config(self, ip_address: str, username: str, password: str, input_id: str):
         """Get input config"""
         logger.debug(f"Invoking get_input_config with ip_address={ip_address}, input_id={input_id}")
-        try:
-            hdr = {"Authorization": f"Bearer {create_auth_header(username, password)}"}
-            async with aiohttp.ClientSession(headers=hdr) as session:
-                async with session.get(f"http://{ip_address}/api/{api_version}/inputs/{input_id}") as response:
-                    if response.status != 200:
-                        if response.status == 401 or response.status == 403:
-                            logger.error(f"Authentication error: {response.status}")
-                            raise AuthenticationException
-                        else:
-                            logger.error(f"Error getting input config: {response.status}")
-                            raise UnexpectedException(response.status)
-                    else:
-                        contents = await response.json()
-                        return contents
-        except aiohttp.ClientError as exc:
-            raise UnexpectedException from exc
-        
+        return await self._get_json(ip_address, username, password, f"inputs/{input_id}", conditional=True)
+
     async def get_available_inputs(self, ip_address: str, username: str, password: str, input_id: str):
         """Get available inputs"""
         logger.debug(f"Invoking get_available_inputs with ip_address={ip_address}, input_id={input_id}")
-        try:
-            hdr = {"Authorization": f"Bearer {create_auth_header(username, password)}"}
-            async with aiohttp.ClientSession(headers=hdr) as session:
-                async with session.get(f"http://{ip_address}/api/{api_version}/inputs/{input_id}/available-types") as response:
-                    if response.status != 200:
-                        if response.status == 401 or response.status == 403:
-                            logger.error(f"Authentication error: {response.status}")
-                            raise AuthenticationException
-                        else:
-                            logger.error(f"Error getting available inputs: {response.status}")
-                            raise UnexpectedException(response.status)
-                    else:
-                        contents = await response.json()
-                        return contents["available_types"]
-        except aiohttp.ClientError as exc:
-            raise UnexpectedException from exc
+        return await self._get_json(ip_address, username, password, f"inputs/{input_id}/available-types", key="available_types")
 
     async def get_input_types(self, ip_address: str, username: str, password: str, input_id: str):
         """Get input types"""
         logger.debug(f"Invoking get_input_types with ip_address={ip_address}, input_id={input_id}")
-        try:
-            hdr = {"Authorization": f"Bearer {create_auth_header(username, password)}"}
-            async with aiohttp.ClientSession(headers=hdr) as session:
-                async with session.get(f"http://{ip_address}/api/{api_version}/inputs/{input_id}/types") as response:
-                    if response.status != 200:
-                        if response.status == 401 or response.status == 403:
-                            logger.error(f"Authentication error: {response.status}")
-                            raise AuthenticationException
-                        else:
-                            logger.error(f"Error getting input types: {response.status}")
-                            raise UnexpectedException(response.status)
-                    else:
-                        contents = await response.json()
-                        return contents["available_types"]
-        except aiohttp.ClientError as exc:
-            raise UnexpectedException from exc
+        return await self._get_json(ip_address, username, password, f"inputs/{input_id}/types", key="available_types")
+
+    async def get_all_device_metrics(self, ip_address: str, username: str, password: str, concurrency: int = 4) -> Dict[str, dict]:
+        """Get metrics for all devices"""
+        logger.debug(f"Invoking get_all_device_metrics with ip_address={ip_address}")
+        device_ids = _as_ids(await self.get_devices(ip_address, username, password), "device_ids")
+        return await _gather_by_id(device_ids, lambda device_id: self.get_device_metrics(ip_address, username, password, device_id), concurrency)
+
+    async def get_all_zone_configs(self, ip_address: str, username: str, password: str, concurrency: int = 4) -> Dict[str, dict]:
+        """Get config for all zones"""
+        logger.debug(f"Invoking get_all_zone_configs with ip_address={ip_address}")
+        zone_ids = _as_ids(await self.get_zones(ip_address, username, password), "zone_ids")
+        return await _gather_by_id(zone_ids, lambda zone_id: self.get_zone_config(ip_address, username, password, zone_id), concurrency)
+
+    async def get_all_input_configs(self, ip_address: str, username: str, password: str, concurrency: int = 4) -> Dict[str, dict]:
+        """Get config for all inputs"""
+        logger.debug(f"Invoking get_all_input_configs with ip_address={ip_address}")
+        input_ids = _as_ids(await self.get_inputs(ip_address, username, password), "input_ids")
+        return await _gather_by_id(input_ids, lambda input_id: self.get_input_config(ip_address, username, password, input_id), concurrency)
 
     async def set_input_type(self, ip_address: str, username: str, password: str, input_id: str, type: str):
         """Set input type"""
         logger.debug(f"Invoking set_input_type with ip_address={ip_address}, input_id={input_id}, type={type}")
         try:
-            hdr = {"Authorization": f"Bearer {create_auth_header(username, password)}"}
-
-            async with aiohttp.ClientSession(headers=hdr) as session:
-                async with session.put(f"http://{ip_address}/api/{api_version}/inputs/{input_id}/type", data =  { "type": type }) as response:
-                    if response.status != 200:
-                        if response.status == 401 or response.status == 403:
-                            logger.error(f"Authentication error: {response.status}")
-                            raise AuthenticationException
-                        else:
-                            logger.error(f"Error setting input type: {response.status}")
-                            raise UnexpectedException(response.status)
-                    else:
-                        contents = await response.text()
-                        return contents
-        except aiohttp.ClientError as exc:
+            hdr = _auth_headers(username, password)
+
+            session = self._get_session()
+            async with session.put(_api_url(ip_address, f"inputs/{input_id}/type"), data =  { "type": type }, headers=hdr) as response:
+                response.raise_for_status()
+                self._invalidate(ip_address, "inputs")
+                contents = await response.text()
+                return contents
+        except aiohttp.ClientResponseError as exc:
+            raise _status_error(exc, "setting input type") from exc
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
             raise UnexpectedException from exc
 
     async def enable_input(self, ip_address: str, username: str, password: str, input_id: str, enable: bool):
         """Enable/disable an input"""
         logger.debug(f"Invoking enable_input with ip_address={ip_address}, input_id={input_id}, enable={enable}")
         try:
-            hdr = {"Authorization": f"Bearer {create_auth_header(username, password)}"}
-
-            async with aiohttp.ClientSession(headers=hdr) as session:
-                async with session.put(f"http://{ip_address}/api/{api_version}/inputs/{input_id}/enable", data =  { "enable": enable }) as response:
-                    if response.status != 200:
-                        if response.status == 401 or response.status == 403:
-                            logger.error(f"Authentication error: {response.status}")
-                            raise AuthenticationException
-                        else:
-                            logger.error(f"Error enabling/disabling input: {response.status}")
-                            raise UnexpectedException(response.status)
-                    else:
-                        contents = await response.text()
-                        return contents
-        except aiohttp.ClientError as exc:
-            raise UnexpectedException from exc
\ No newline at end of file
+            hdr = _auth_headers(username, password)
+
+            session = self._get_session()
+            async with session.put(_api_url(ip_address, f"inputs/{input_id}/enable"), data =  { "enable": enable }, headers=hdr) as response:
+                response.raise_for_status()
+                self._invalidate(ip_address, "inputs")
+                contents = await response.text()
+                return contents
+        except aiohttp.ClientResponseError as exc:
+            raise _status_error(exc, "enabling/disabling input") from exc
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            raise UnexpectedException from exc
+
+
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, JukeAudioClient]" = weakref.WeakKeyDictionary()
+
+
+async def get_client() -> JukeAudioClient:
+    """Return the client shared by all callers on the running event loop
+
+    Close the client before its event loop shuts down; a session left open
+    on a closed loop cannot be closed later. A closed client is dropped
+    along with its loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = JukeAudioClient()
+    return client
\ No newline at end of file
@@ -0,0 +1,302 @@
+"""Tests for the Juke Audio clients against a local aiohttp server"""
+
+import asyncio
+import gc
+import unittest
+import weakref
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from jukeaudio import jukeaudio, jukeaudio_v3
+from jukeaudio.exceptions import AuthenticationException, UnexpectedException
+
+AUTH = "Bearer dTpw"
+
+
+class FakeJuke:
+    """Minimal stand-in for the Juke API, recording the requests it receives"""
+
+    def __init__(self):
+        self.requests = []
+        self.volumes = []
+        self.bodies = []
+        self.zone_ids = ["z1", "z2"]
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.peers = set()
+        self.app = web.Application()
+        self.app.router.add_get("/api/{version}/zones", self.zones)
+        self.app.router.add_get("/api/{version}/zones/{zone_id}", self.zone_config)
+        self.app.router.add_get("/api/{version}/devices/{device_id}/config", self.device_config)
+        self.app.router.add_get("/api/{version}/devices/{device_id}/metrics", self.device_metrics)
+        self.app.router.add_put("/api/{version}/zones/{zone_id}/volume", self.zone_volume)
+        self.app.router.add_put("/api/{version}/zones/{zone_id}/input", self.zone_input)
+
+    def record(self, request):
+        self.requests.append((request.method, request.path, request.headers.get("If-None-Match")))
+        self.peers.add(request.transport.get_extra_info("peername"))
+        if request.headers.get("Authorization") != AUTH:
+            raise web.HTTPUnauthorized()
+
+    async def record_body(self, request):
+        body = await request.json()
+        self.bodies.append((request.content_type, body))
+        return body
+
+    async def zones(self, request):
+        self.record(request)
+        return web.json_response({"zone_ids": self.zone_ids})
+
+    async def zone_config(self, request):
+        self.record(request)
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        await asyncio.sleep(0.02)
+        self.in_flight -= 1
+        return web.json_response({"name": request.match_info["zone_id"]})
+
+    async def device_config(self, request):
+        self.record(request)
+        if request.headers.get("If-None-Match") == '"c1"':
+            return web.Response(status=304, headers={"ETag": '"c1"'})
+        return web.json_response({"name": "amp", "zones": [1, 2]}, headers={"ETag": '"c1"'})
+
+    async def device_metrics(self, request):
+        self.record(request)
+        if request.match_info["device_id"] == "html":
+            return web.Response(text="<html>Service unavailable</html>", content_type="text/html")
+        if request.match_info["device_id"] == "big":
+            # Chunked, so no Content-Length; requested fields come first
+            response = web.StreamResponse()
+            response.enable_chunked_encoding()
+            await response.prepare(request)
+            await response.write(b'{"cpu": 1.5, "temp": 40, "history": [')
+            await response.write(b",".join(b"%d" % i for i in range(10000)))
+            await response.write(b"]}")
+            await response.write_eof()
+            return response
+        # Send the body in two parts, so a client that stops reading after the
+        # first part leaves the rest unread on the connection
+        head, tail = b'{"cpu": 1.5, "temp": 40, "uptime": ', b"100}"
+        response = web.StreamResponse()
+        response.content_length = len(head) + len(tail)
+        await response.prepare(request)
+        await response.write(head)
+        await asyncio.sleep(0.01)
+        await response.write(tail)
+        return response
+
+    async def zone_volume(self, request):
+        self.record(request)
+        volume = (await self.record_body(request))["volume"]
+        if volume == 10:
+            # Hold the first write so a later one would overtake it if unordered
+            await asyncio.sleep(0.2)
+        self.volumes.append(volume)
+        return web.Response(text="ok")
+
+    async def zone_input(self, request):
+        self.record(request)
+        await self.record_body(request)
+        return web.Response(text="ok")
+
+
+def open_connections(client):
+    """Return the number of connections pooled by a client's session"""
+    return sum(len(conns) for conns in client._session.connector._conns.values())
+
+
+class ClientTestsMixin:
+    """Tests shared by the v2 and v3 clients"""
+
+    module = None
+    client_class = None
+    input_body = None
+
+    async def asyncSetUp(self):
+        self.juke = FakeJuke()
+        self.server = TestServer(self.juke.app)
+        await self.server.start_server()
+        self.ip_address = f"{self.server.host}:{self.server.port}"
+        self.client = self.client_class()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.server.close()
+
+    async def test_get_client_reuses_one_connection(self):
+        client = await self.module.get_client()
+        try:
+            for _ in range(5):
+                await client.get_device_metrics(self.ip_address, "u", "p", "d1")
+                self.assertEqual(open_connections(client), 1)
+            self.assertEqual(len(self.juke.peers), 1)
+            self.assertIs(await self.module.get_client(), client)
+        finally:
+            await client.close()
+
+    async def test_cached_result_is_not_shared(self):
+        zones = await self.client.get_zones(self.ip_address, "u", "p")
+        zones["zone_ids"].append("junk")
+        self.assertEqual(await self.client.get_zones(self.ip_address, "u", "p"), {"zone_ids": ["z1", "z2"]})
+        self.assertEqual(len(self.juke.requests), 1)
+
+    async def test_zone_write_invalidates_cache(self):
+        await self.client.get_zones(self.ip_address, "u", "p")
+        await self.client.set_zone_input(self.ip_address, "u", "p", "z1", "i1")
+        await self.client.get_zones(self.ip_address, "u", "p")
+        self.assertEqual([r[1] for r in self.juke.requests].count(f"/api/{self.module.api_version}/zones"), 2)
+
+    async def test_etag_revalidation(self):
+        first = await self.client.get_device_config(self.ip_address, "u", "p", "d1")
+        first["zones"].append(3)
+        second = await self.client.get_device_config(self.ip_address, "u", "p", "d1")
+        self.assertEqual(second, {"name": "amp", "zones": [1, 2]})
+        self.assertEqual([r[2] for r in self.juke.requests], [None, '"c1"'])
+
+    async def test_get_all_zone_configs_limits_concurrency(self):
+        self.juke.zone_ids = [f"z{i}" for i in range(6)]
+        configs = await self.client.get_all_zone_configs(self.ip_address, "u", "p", concurrency=2)
+        self.assertEqual(configs, {zone_id: {"name": zone_id} for zone_id in self.juke.zone_ids})
+        self.assertEqual(self.juke.peak_in_flight, 2)
+
+    async def test_get_all_zone_configs_rejects_zero_concurrency(self):
+        with self.assertRaises(ValueError):
+            await self.client.get_all_zone_configs(self.ip_address, "u", "p", concurrency=0)
+
+    async def test_zone_writes_send_json(self):
+        await self.client.set_zone_input(self.ip_address, "u", "p", "z1", "i1")
+        await self.client.set_zone_input(self.ip_address, "u", "p", "z1", "")
+        await self.client.set_zone_volume(self.ip_address, "u", "p", "z1", 20)
+        self.assertEqual(self.juke.bodies, [
+            ("application/json", self.input_body(["i1"])),
+            ("application/json", self.input_body([])),
+            ("application/json", {"volume": 20}),
+        ])
+
+    async def test_volume_burst_is_coalesced(self):
+        results = await asyncio.gather(*(self.client.set_zone_volume(self.ip_address, "u", "p", "z1", v) for v in range(20, 30)))
+        self.assertEqual(results, ["ok"] * 10)
+        self.assertEqual(self.juke.volumes, [29])
+
+    async def test_close_waits_for_inflight_volume_write(self):
+        write = asyncio.ensure_future(self.client.set_zone_volume(self.ip_address, "u", "p", "z1", 10))
+        await asyncio.sleep(0.1)
+        await self.client.close()
+        self.assertEqual(await write, "ok")
+        self.assertEqual(self.juke.volumes, [10])
+
+    async def test_volume_writes_keep_order(self):
+        first = asyncio.ensure_future(self.client.set_zone_volume(self.ip_address, "u", "p", "z1", 10))
+        await asyncio.sleep(0.1)
+        second = asyncio.ensure_future(self.client.set_zone_volume(self.ip_address, "u", "p", "z1", 20))
+        await asyncio.gather(first, second)
+        self.assertEqual(self.juke.volumes, [10, 20])
+
+    async def test_volume_writes_keep_credentials_apart(self):
+        results = await asyncio.gather(
+            self.client.set_zone_volume(self.ip_address, "u", "p", "z1", 20),
+            self.client.set_zone_volume(self.ip_address, "u", "wrong", "z1", 30),
+            return_exceptions=True,
+        )
+        self.assertEqual(results[0], "ok")
+        self.assertIsInstance(results[1], AuthenticationException)
+        self.assertEqual(self.juke.volumes, [20])
+
+    async def test_failed_volume_write_without_waiters_is_not_logged(self):
+        errors = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        write = asyncio.ensure_future(self.client.set_zone_volume(self.ip_address, "u", "wrong", "z1", 20))
+        await asyncio.sleep(0)
+        write.cancel()
+        await self.client.flush()
+        gc.collect()
+        self.assertEqual(errors, [])
+
+    async def test_metrics_fields_small_payload_keeps_connection(self):
+        for _ in range(6):
+            metrics = await self.client.get_device_metrics_fields(self.ip_address, "u", "p", "d1", {"cpu", "temp"})
+            self.assertEqual(metrics, {"cpu": 1.5, "temp": 40})
+        self.assertEqual(len(self.juke.peers), 1)
+
+    @unittest.skipIf(jukeaudio.ijson is None, "ijson is not installed")
+    async def test_metrics_fields_streams_large_payload(self):
+        metrics = await self.client.get_device_metrics_fields(self.ip_address, "u", "p", "big", {"cpu", "temp"})
+        self.assertEqual(metrics, {"cpu": 1.5, "temp": 40})
+
+    async def test_invalid_json_raises_unexpected_exception(self):
+        with self.assertRaises(UnexpectedException):
+            await self.client.get_device_metrics(self.ip_address, "u", "p", "html")
+        with self.assertRaises(UnexpectedException):
+            await self.client.get_device_metrics_fields(self.ip_address, "u", "p", "html", {"cpu"})
+
+    @unittest.skipIf(jukeaudio.ijson is None, "ijson is not installed")
+    async def test_invalid_json_raises_unexpected_exception_when_streaming(self):
+        self.client.stream_threshold = 0
+        with self.assertRaises(UnexpectedException):
+            await self.client.get_device_metrics_fields(self.ip_address, "u", "p", "html", {"cpu"})
+
+    async def test_authentication_error(self):
+        with self.assertRaises(AuthenticationException):
+            await self.client.get_zones(self.ip_address, "u", "wrong")
+
+
+class JukeAudioClientTests(ClientTestsMixin, unittest.IsolatedAsyncioTestCase):
+    module = jukeaudio
+    client_class = jukeaudio.JukeAudioClient
+    input_body = staticmethod(lambda input_ids: input_ids)
+
+
+class JukeAudioClientV3Tests(ClientTestsMixin, unittest.IsolatedAsyncioTestCase):
+    module = jukeaudio_v3
+    client_class = jukeaudio_v3.JukeAudioClientV3
+    input_body = staticmethod(lambda input_ids: {"input_ids": input_ids})
+
+
+class EventLoopTests(unittest.TestCase):
+    def test_client_is_reusable_across_event_loops(self):
+        client = jukeaudio.JukeAudioClient()
+
+        async def use_client(close):
+            juke = FakeJuke()
+            async with TestServer(juke.app) as server:
+                ip_address = f"{server.host}:{server.port}"
+                await client.get_device_config(ip_address, "u", "p", "d1")
+                self.assertEqual(await client.set_zone_volume(ip_address, "u", "p", "z1", 20), "ok")
+                session = client._session
+                if close:
+                    await client.close()
+                return session
+
+        # Leave the first loop open so its session can be closed at the end
+        first_loop = asyncio.new_event_loop()
+        try:
+            first_session = first_loop.run_until_complete(use_client(False))
+            self.assertIsNot(asyncio.run(use_client(True)), first_session)
+            first_loop.run_until_complete(first_session.close())
+        finally:
+            first_loop.close()
+
+
+class GetClientTests(unittest.TestCase):
+    def test_client_is_dropped_with_its_loop(self):
+        async def use_client():
+            juke = FakeJuke()
+            async with TestServer(juke.app) as server:
+                client = await jukeaudio.get_client()
+                self.assertIs(await jukeaudio.get_client(), client)
+                await client.get_zones(f"{server.host}:{server.port}", "u", "p")
+                await client.close()
+            return weakref.ref(client)
+
+        first = asyncio.run(use_client())
+        second = asyncio.run(use_client())
+        gc.collect()
+        self.assertIsNone(first())
+        self.assertIsNone(second())
+        self.assertEqual(len(jukeaudio._clients), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()